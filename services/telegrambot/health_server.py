@@ -0,0 +1,162 @@
+"""
+Health Server Module
+HTTP эндпоинты для оркестрации: liveness, readiness, лаг и пропускная способность
+"""
+
+import asyncio
+import math
+import time
+from typing import Dict, Any, Optional
+from loguru import logger
+from aiohttp import web
+
+from kafka_client import KafkaClient
+from telegram_client import TelegramClient
+from tracing import Tracer, LoopLagMonitor, SamplingProfiler
+
+
+class HealthServer:
+    """HTTP сервер health-проверок в том же event loop, что и обработка сообщений"""
+
+    def __init__(
+        self,
+        kafka_client: KafkaClient,
+        telegram_client: Optional[TelegramClient],
+        loop_monitor: LoopLagMonitor,
+        tracer: Optional[Tracer] = None,
+        profiler: Optional[SamplingProfiler] = None,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        stall_timeout: float = 60.0,
+        telegram_check_ttl: float = 30.0,
+        telegram_check_timeout: float = 5.0
+    ):
+        self.kafka_client = kafka_client
+        self.telegram_client = telegram_client
+        self.loop_monitor = loop_monitor
+        self.tracer = tracer
+        self.profiler = profiler
+        self.host = host
+        self.port = port
+        self.stall_timeout = stall_timeout
+        self.telegram_check_ttl = telegram_check_ttl
+        self.telegram_check_timeout = telegram_check_timeout
+        self.runner: Optional[web.AppRunner] = None
+
+        # Кэш результата get_me: проверка Telegram не выполняется на каждый запрос
+        self.telegram_reachable: Optional[bool] = None
+        self.telegram_checked_at: float = 0.0
+        self._telegram_check_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Запуск HTTP сервера"""
+        app = web.Application()
+        app.router.add_get("/healthz", self.handle_healthz)
+        app.router.add_get("/readyz", self.handle_readyz)
+        app.router.add_get("/lag", self.handle_lag)
+        if self.profiler:
+            app.router.add_post("/debug/profile", self.handle_profile)
+
+        # Без access-лога: проверки оркестратора не должны нагружать логирование
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+        self._schedule_telegram_check()
+        logger.info(f"Health сервер запущен на {self.host}:{self.port}")
+
+    async def stop(self):
+        """Остановка HTTP сервера"""
+        if self._telegram_check_task:
+            self._telegram_check_task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+            logger.info("Health сервер остановлен")
+
+    def _schedule_telegram_check(self):
+        """Фоновое обновление кэша get_me, если он устарел"""
+        if not self.telegram_client:
+            return
+        if self._telegram_check_task and not self._telegram_check_task.done():
+            return
+        if time.monotonic() - self.telegram_checked_at < self.telegram_check_ttl and self.telegram_reachable is not None:
+            return
+        self._telegram_check_task = asyncio.get_running_loop().create_task(self._check_telegram())
+
+    async def _check_telegram(self):
+        try:
+            bot_info = await asyncio.wait_for(self.telegram_client.get_me(), self.telegram_check_timeout)
+            self.telegram_reachable = bool(bot_info)
+        except Exception as e:
+            logger.warning(f"Проверка доступности Telegram не удалась: {e}")
+            self.telegram_reachable = False
+        self.telegram_checked_at = time.monotonic()
+
+    def _consumer_status(self) -> Dict[str, Any]:
+        """Состояние цикла потребления: нет ни poll, ни обработанных сообщений дольше stall_timeout"""
+        last_progress_at = self.kafka_client.last_progress_at
+        if not self.kafka_client.consuming or last_progress_at is None:
+            return {"alive": True, "state": "starting"}
+
+        since_progress = time.monotonic() - last_progress_at
+        return {
+            "alive": since_progress < self.stall_timeout,
+            "state": "consuming" if since_progress < self.stall_timeout else "stalled",
+            "seconds_since_progress": round(since_progress, 3)
+        }
+
+    async def handle_healthz(self, request: web.Request) -> web.Response:
+        """Liveness: event loop отвечает и цикл потребления не завис"""
+        consumer = self._consumer_status()
+        body = {
+            "status": "ok" if consumer["alive"] else "stalled",
+            "loop_lag_ms": round(self.loop_monitor.last_lag * 1000, 2),
+            "loop_max_lag_ms": round(self.loop_monitor.max_lag * 1000, 2),
+            "consumer": consumer
+        }
+        return web.json_response(body, status=200 if consumer["alive"] else 503)
+
+    async def handle_readyz(self, request: web.Request) -> web.Response:
+        """Readiness: партиции Kafka назначены, Telegram доступен (по кэшу get_me)"""
+        self._schedule_telegram_check()
+
+        assigned = bool(self.kafka_client.assigned_partitions)
+        if self.telegram_client:
+            telegram = "ok" if self.telegram_reachable else ("unknown" if self.telegram_reachable is None else "unreachable")
+        else:
+            telegram = "not_configured"
+
+        ready = assigned and telegram in ("ok", "not_configured")
+        body = {
+            "status": "ready" if ready else "not_ready",
+            "kafka_assigned_partitions": self.kafka_client.assigned_partitions,
+            "telegram": telegram
+        }
+        return web.json_response(body, status=200 if ready else 503)
+
+    async def handle_lag(self, request: web.Request) -> web.Response:
+        """Лаг consumer и пропускная способность (для автоскейлинга)"""
+        body = self.kafka_client.get_stats()
+        body["loop_lag_ms"] = round(self.loop_monitor.last_lag * 1000, 2)
+        if self.tracer and self.tracer.enabled:
+            body["stages"] = self.tracer.snapshot()
+            body["slow_messages"] = self.tracer.slow_messages
+        return web.json_response(body)
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        """Запуск сэмплирующего профилировщика"""
+        try:
+            duration = float(request.query["duration"]) if "duration" in request.query else None
+        except ValueError:
+            return web.json_response({"error": "duration должен быть числом"}, status=400)
+        # Иначе профилировщик может работать бесконечно и блокировать следующие запуски
+        if duration is not None and not (math.isfinite(duration) and 0 < duration <= self.profiler.max_duration):
+            return web.json_response(
+                {"error": f"duration должен быть больше 0 и не больше {self.profiler.max_duration}"}, status=400
+            )
+
+        path = self.profiler.trigger(duration)
+        if path is None:
+            return web.json_response({"error": "Профилирование уже выполняется"}, status=409)
+        return web.json_response({"status": "started", "output": path}, status=202)
@@ -6,91 +6,382 @@ Kafka Client Module
 import asyncio
 import json
 import os
-from typing import Dict, Any, Callable
+import re
+import time
+from collections import deque
+from typing import Dict, Any, Callable, List, Optional, Pattern, Set, Tuple, Union
 from loguru import logger
 from kafka import KafkaConsumer
 from kafka.errors import KafkaError
+from kafka.structs import OffsetAndMetadata
+
+from tracing import Tracer, stage
+
+MessageHandler = Callable[[Dict[str, Any]], Any]
+
+
+def make_offset(offset: int) -> OffsetAndMetadata:
+    """OffsetAndMetadata для commit (в kafka-python 2.1+ добавлено поле leader_epoch)"""
+    if len(OffsetAndMetadata._fields) == 3:
+        return OffsetAndMetadata(offset, "", -1)
+    return OffsetAndMetadata(offset, "")
+
 
 class KafkaClient:
     """Клиент для работы с Kafka"""
-    
-    def __init__(self, brokers: str, topic: str, group_id: str):
+
+    def __init__(
+        self,
+        brokers: str,
+        topic: Union[str, List[str], None] = None,
+        group_id: str = None,
+        pattern: Optional[str] = None,
+        max_poll_records: int = 100,
+        poll_timeout_ms: int = 1000,
+        max_poll_interval_ms: int = 300000,
+        shutdown_timeout: float = 5.0,
+        default_concurrency: int = 10,
+        tracer: Optional[Tracer] = None
+    ):
         self.brokers = brokers
-        self.topic = topic
+        # Допускаем как один топик, так и список топиков
+        if isinstance(topic, str):
+            self.topics = [t.strip() for t in topic.split(",") if t.strip()]
+        else:
+            self.topics = list(topic or [])
+        self.topic = ",".join(self.topics)
+        self.pattern = pattern
         self.group_id = group_id
+        self.max_poll_records = max_poll_records
+        self.poll_timeout_ms = poll_timeout_ms
+        # Должен покрывать обработку пачки в худшем случае, иначе consumer исключается из группы
+        self.max_poll_interval_ms = max_poll_interval_ms
+        # Сколько ждать уже начатые обработчики при остановке, прежде чем отменить их
+        self.shutdown_timeout = shutdown_timeout
+        self.default_concurrency = default_concurrency
+        self.tracer = tracer or Tracer(enabled=False)
         self.consumer = None
         self.running = False
+        self.consuming = False
+        self._stopping = asyncio.Event()
         self.message_handler: Callable = None
-    
+
+        # Состояние для health/readiness: назначенные партиции, лаг, время последнего poll, пропускная способность
+        self.assigned_partitions: List[str] = []
+        # Лаг = highwater - наименьший незавершённый offset партиции. Сообщения одной партиции
+        # обрабатываются параллельно и завершаются не по порядку, поэтому храним offset'ы в обработке
+        self._highwater: Dict[str, int] = {}
+        self._pending_offsets: Dict[Any, Set[int]] = {}
+        self._next_offsets: Dict[Any, int] = {}
+        self.last_poll_at: Optional[float] = None
+        # Heartbeat прогресса: обновляется после poll и после каждого обработанного сообщения
+        self.last_progress_at: Optional[float] = None
+        self.messages_processed = 0
+        self._throughput_window: deque = deque()
+        self.throughput_window_seconds = 60.0
+
+        # Обработчики по точному имени топика и по regex-шаблону
+        self.topic_handlers: Dict[str, Tuple[MessageHandler, asyncio.Semaphore]] = {}
+        self.pattern_handlers: List[Tuple[Pattern, MessageHandler, asyncio.Semaphore]] = []
+        # Кэш разрешения топик -> обработчик, чтобы не прогонять regex на каждое сообщение
+        self._dispatch_cache: Dict[str, Optional[Tuple[MessageHandler, asyncio.Semaphore]]] = {}
+
+        if not self.topics and not self.pattern:
+            raise ValueError("Необходимо указать топик(и) или шаблон подписки")
+
     def setup_consumer(self):
         """Настройка Kafka consumer"""
         try:
             self.consumer = KafkaConsumer(
-                self.topic,
                 bootstrap_servers=self.brokers,
                 group_id=self.group_id,
                 auto_offset_reset='earliest',
-                enable_auto_commit=True,
-                auto_commit_interval_ms=1000,
+                # Offset'ы фиксируются вручную после обработки всей пачки
+                enable_auto_commit=False,
                 session_timeout_ms=30000,
-                value_deserializer=lambda m: json.loads(m.decode('utf-8'))
+                max_poll_records=self.max_poll_records,
+                max_poll_interval_ms=self.max_poll_interval_ms
             )
-            logger.info(f"✅ Kafka consumer настроен для топика: {self.topic}")
+
+            # Одно подключение на все топики: либо по шаблону, либо по списку
+            if self.pattern:
+                self.consumer.subscribe(pattern=self.pattern)
+                logger.info(f"✅ Kafka consumer настроен для шаблона: {self.pattern}")
+            else:
+                self.consumer.subscribe(topics=self.topics)
+                logger.info(f"✅ Kafka consumer настроен для топиков: {self.topic}")
         except Exception as e:
             logger.error(f"Ошибка настройки Kafka consumer: {e}")
             raise
-    
+
     def set_message_handler(self, handler: Callable[[Dict[str, Any]], None]):
-        """Установка обработчика сообщений"""
+        """Установка обработчика сообщений (по умолчанию, для всех топиков)"""
         self.message_handler = handler
+        self._dispatch_cache.clear()
         logger.info("Обработчик сообщений установлен")
-    
+
+    def register_handler(self, topic: str, handler: MessageHandler, concurrency: int = None):
+        """Регистрация обработчика для конкретного топика"""
+        limit = concurrency or self.default_concurrency
+        self.topic_handlers[topic] = (handler, asyncio.Semaphore(limit))
+        self._dispatch_cache.clear()
+        logger.info(f"Обработчик для топика '{topic}' зарегистрирован (параллелизм: {limit})")
+
+    def register_pattern_handler(self, pattern: str, handler: MessageHandler, concurrency: int = None):
+        """Регистрация обработчика для топиков, подходящих под regex-шаблон"""
+        limit = concurrency or self.default_concurrency
+        self.pattern_handlers.append((re.compile(pattern), handler, asyncio.Semaphore(limit)))
+        self._dispatch_cache.clear()
+        logger.info(f"Обработчик для шаблона '{pattern}' зарегистрирован (параллелизм: {limit})")
+
+    def _resolve_handler(self, topic: str) -> Optional[Tuple[MessageHandler, asyncio.Semaphore]]:
+        """Поиск обработчика для топика: точное имя, затем шаблоны, затем обработчик по умолчанию"""
+        if topic in self._dispatch_cache:
+            return self._dispatch_cache[topic]
+
+        resolved = self.topic_handlers.get(topic)
+        if resolved is None:
+            for compiled, handler, semaphore in self.pattern_handlers:
+                if compiled.fullmatch(topic):
+                    resolved = (handler, semaphore)
+                    break
+        if resolved is None and self.message_handler:
+            # Обработчик по умолчанию получает собственный лимит параллелизма на топик
+            resolved = (self.message_handler, asyncio.Semaphore(self.default_concurrency))
+
+        self._dispatch_cache[topic] = resolved
+        return resolved
+
     async def start_consuming(self):
         """Начало потребления сообщений"""
         if not self.consumer:
             self.setup_consumer()
-        
+
         self.running = True
+        self.consuming = True
+        self._stopping.clear()
+        loop = asyncio.get_running_loop()
         logger.info("Начало потребления сообщений из Kafka")
-        
+
         try:
-            for message in self.consumer:
-                if not self.running:
-                    break
-                
-                try:
-                    message_data = message.value
-                    logger.info(f"Получено сообщение: {message_data}")
-                    
-                    if self.message_handler:
-                        # Синхронная обработка сообщения
-                        await self._handle_message(message_data)
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка обработки сообщения: {e}")
-                
+            while self.running:
+                # poll блокирующий, поэтому выносим его из event loop
+                fetch_started = time.perf_counter()
+                batch = await loop.run_in_executor(None, self._poll)
+                if not batch or not self.running:
+                    continue
+
+                # Время poll включает ожидание новых сообщений, поэтому учитывается на уровне пачки
+                if self.tracer.enabled:
+                    self.tracer.record("fetch", time.perf_counter() - fetch_started)
+
+                await self._dispatch_batch(batch)
+                await self._commit(loop)
+                self._record_throughput(sum(len(messages) for messages in batch.values()))
+
         except KeyboardInterrupt:
             logger.info("Получен сигнал остановки")
         except Exception as e:
             logger.error(f"Ошибка при потреблении сообщений: {e}")
         finally:
+            self.consuming = False
             await self.stop()
-    
-    async def _handle_message(self, message: Dict[str, Any]):
-        """Асинхронная обработка сообщения"""
+
+    def _poll(self) -> Dict[Any, List[Any]]:
+        """poll и снимок состояния consumer (выполняется в потоке executor)"""
+        batch = self.consumer.poll(timeout_ms=self.poll_timeout_ms, max_records=self.max_poll_records)
+        self.last_poll_at = time.monotonic()
+        self.last_progress_at = self.last_poll_at
+
+        # Highwater берётся из кэша последнего fetch, без лишних запросов к брокеру.
+        # position уже сдвинут за полученную пачку: пока её сообщения в обработке,
+        # точкой обработки партиции считается наименьший незавершённый offset
+        assignment = self.consumer.assignment()
+        highwater_offsets = {}
+        pending_offsets = {}
+        next_offsets = {}
+        for tp in assignment:
+            highwater = self.consumer.highwater(tp)
+            if highwater is not None:
+                highwater_offsets[f"{tp.topic}[{tp.partition}]"] = highwater
+            pending_offsets[tp] = {record.offset for record in batch.get(tp, ())}
+            next_offsets[tp] = self.consumer.position(tp)
+        self.assigned_partitions = sorted(f"{tp.topic}[{tp.partition}]" for tp in assignment)
+        self._highwater = highwater_offsets
+        self._pending_offsets = pending_offsets
+        self._next_offsets = next_offsets
+        return batch
+
+    def _record_throughput(self, count: int):
+        """Учёт обработанных сообщений для расчёта пропускной способности"""
+        now = time.monotonic()
+        self.messages_processed += count
+        self._throughput_window.append((now, count))
+        while self._throughput_window and self._throughput_window[0][0] < now - self.throughput_window_seconds:
+            self._throughput_window.popleft()
+
+    def _unfinished_offsets(self) -> Dict[str, int]:
+        """Наименьший незавершённый offset по партициям (position, если вся пачка обработана)"""
+        return {
+            f"{tp.topic}[{tp.partition}]": min(pending) if pending else self._next_offsets[tp]
+            for tp, pending in self._pending_offsets.items()
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Лаг, назначенные партиции и пропускная способность consumer"""
+        now = time.monotonic()
+        recent = sum(count for at, count in self._throughput_window if at >= now - self.throughput_window_seconds)
+        unfinished = self._unfinished_offsets()
+        partition_lag = {
+            key: max(0, highwater - unfinished[key])
+            for key, highwater in self._highwater.items()
+            if key in unfinished
+        }
+        return {
+            "assigned_partitions": self.assigned_partitions,
+            "lag": partition_lag,
+            "total_lag": sum(partition_lag.values()),
+            "messages_processed": self.messages_processed,
+            "throughput_per_sec": round(recent / self.throughput_window_seconds, 3),
+            "seconds_since_poll": round(now - self.last_poll_at, 3) if self.last_poll_at else None,
+            "seconds_since_progress": round(now - self.last_progress_at, 3) if self.last_progress_at else None
+        }
+
+    async def _commit(self, loop: asyncio.AbstractEventLoop):
+        """Фиксация offset'ов: по каждой партиции до первого необработанного сообщения"""
+        commit_started = time.perf_counter()
+        offsets = {
+            tp: make_offset(min(pending) if pending else self._next_offsets[tp])
+            for tp, pending in self._pending_offsets.items()
+        }
+        if not offsets:
+            return
         try:
-            if self.message_handler:
-                await self.message_handler(message)
-        except Exception as e:
-            logger.error(f"Ошибка в обработчике сообщений: {e}")
-    
+            await loop.run_in_executor(None, lambda: self.consumer.commit(offsets))
+        except KafkaError as e:
+            logger.error(f"Ошибка фиксации offset'ов: {e}")
+        if self.tracer.enabled:
+            self.tracer.record("commit", time.perf_counter() - commit_started)
+
+    async def _dispatch_batch(self, batch: Dict[Any, List[Any]]):
+        """Распределение пачки сообщений по обработчикам топиков"""
+        tasks = []
+        # Блокировки порядка действуют в пределах пачки: следующая пачка начинается после завершения текущей
+        order_locks: Dict[Tuple[str, Any], asyncio.Lock] = {}
+        for topic_partition, messages in batch.items():
+            resolved = self._resolve_handler(topic_partition.topic)
+            pending = self._pending_offsets.setdefault(topic_partition, set())
+            if resolved is None:
+                logger.error(f"Нет обработчика для топика {topic_partition.topic}: пропущено сообщений: {len(messages)}")
+                # Пропущенные сообщения не должны держать лаг партиции
+                pending.clear()
+                continue
+
+            handler, semaphore = resolved
+            for message in messages:
+                tasks.append(asyncio.ensure_future(
+                    self._handle_message(handler, semaphore, message, pending, order_locks)
+                ))
+
+        if not tasks:
+            return
+
+        # Ждём всю пачку перед фиксацией offset'ов и следующим poll, но не дольше запроса остановки
+        batch_done = asyncio.gather(*tasks, return_exceptions=True)
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        await asyncio.wait({batch_done, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if batch_done.done():
+            return
+
+        # Остановка: новые сообщения не начинаются, начатым даётся shutdown_timeout, остальные отменяются.
+        # Отменённые остаются незавершёнными и будут получены повторно после перезапуска
+        _, unfinished = await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+        if unfinished:
+            logger.warning(f"Остановка: отменено незавершённых обработчиков: {len(unfinished)}")
+            for task in unfinished:
+                task.cancel()
+        await batch_done
+
+    @staticmethod
+    def _ordering_key(record: Any, message: Any) -> Any:
+        """Ключ порядка обработки: ключ записи Kafka, иначе client_id события"""
+        if record.key is not None:
+            return record.key
+        data = message.get("data") if isinstance(message, dict) else None
+        return data.get("client_id") if isinstance(data, dict) else None
+
+    async def _handle_message(
+        self,
+        handler: MessageHandler,
+        semaphore: asyncio.Semaphore,
+        record: Any,
+        pending: Set[int],
+        order_locks: Dict[Tuple[str, Any], asyncio.Lock]
+    ):
+        """Асинхронная обработка сообщения; по завершении offset убирается из незавершённых партиции"""
+        # Каждая задача работает в своём контексте, поэтому трассировки не пересекаются
+        trace = self.tracer.start(record.topic, record.partition, record.offset)
+        completed = False
+        try:
+            with stage("decode"):
+                try:
+                    # Tombstone (value=None) и любые ошибки разбора не должны останавливать цикл потребления
+                    if record.value is None:
+                        raise ValueError("пустое значение (tombstone)")
+                    message = json.loads(record.value.decode('utf-8'))
+                except Exception as e:
+                    logger.error(f"Некорректное сообщение {record.topic}[{record.partition}]@{record.offset}: {e}")
+                    completed = True
+                    return
+            logger.info(f"Получено сообщение из {record.topic}: {message}")
+
+            # События одного клиента обрабатываются строго по порядку offset'ов, разные клиенты — параллельно.
+            # До этой точки задача не уступает управление, поэтому блокировку запрашивают в порядке пачки
+            order_key = self._ordering_key(record, message)
+            if order_key is None:
+                order_lock = asyncio.Lock()
+            else:
+                order_lock = order_locks.setdefault((record.topic, order_key), asyncio.Lock())
+
+            with stage("wait"):
+                await order_lock.acquire()
+            try:
+                with stage("wait"):
+                    await semaphore.acquire()
+                try:
+                    if self._stopping.is_set():
+                        # Остановка: сообщение не обрабатывается и не фиксируется
+                        return
+                    with stage("handle"):
+                        await handler(message)
+                except Exception as e:
+                    logger.error(f"Ошибка в обработчике сообщений: {e}")
+                finally:
+                    semaphore.release()
+                completed = True
+            finally:
+                order_lock.release()
+        finally:
+            self.last_progress_at = time.monotonic()
+            if completed:
+                pending.discard(record.offset)
+            self.tracer.finish(trace)
+
+    def request_stop(self):
+        """Запрос остановки: текущая пачка не дообрабатывается, фиксируется только обработанное"""
+        self.running = False
+        self._stopping.set()
+
     async def stop(self):
         """Остановка consumer"""
-        self.running = False
-        if self.consumer:
+        self.request_stop()
+        # Пока идёт poll в executor, закрытием займётся сам цикл потребления
+        if self.consumer and not self.consuming:
             self.consumer.close()
+            self.consumer = None
             logger.info("Kafka consumer остановлен")
-    
+
     def send_message(self, topic: str, message: Dict[str, Any]):
         """Отправка сообщения в Kafka (для будущего использования)"""
         # TODO: Реализовать producer для отправки сообщений
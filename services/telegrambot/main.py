@@ -14,7 +14,10 @@ from dotenv import load_dotenv
 
 # Импорт наших модулей
 from kafka_client import KafkaClient
-from telegram_client import TelegramClient
+from telegram_client import TelegramClient, split_group_budget
+from recipient_resolver import RecipientResolver
+from tracing import Tracer, LoopLagMonitor, SamplingProfiler, stage
+from health_server import HealthServer
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -35,15 +38,85 @@ class TelegramBotService:
         # Конфигурация Kafka
         self.kafka_brokers = os.getenv("KAFKA_BROKERS", "kafka:29092")
         self.kafka_topic = os.getenv("KAFKA_TOPIC", "crm-msgAccepted")
+        self.kafka_error_topic = os.getenv("KAFKA_ERROR_TOPIC", "crm-msgError")
+        self.kafka_topic_pattern = os.getenv("KAFKA_TOPIC_PATTERN") or None
+        self.kafka_max_poll_records = int(os.getenv("KAFKA_MAX_POLL_RECORDS", "100"))
+        self.accepted_concurrency = int(os.getenv("KAFKA_ACCEPTED_CONCURRENCY", "10"))
+        self.error_concurrency = int(os.getenv("KAFKA_ERROR_CONCURRENCY", "2"))
         self.kafka_group_id = os.getenv("KAFKA_GROUP_ID", "telegram_bot_group")
+        self.kafka_shutdown_timeout = float(os.getenv("KAFKA_SHUTDOWN_TIMEOUT", "5"))
         
         # Конфигурация Telegram
         self.telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
         self.telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID")
+        self.telegram_private_chat_interval = float(os.getenv("TELEGRAM_PRIVATE_CHAT_INTERVAL", "1.0"))
+        # Часть лимита группового чата оставляется для replay, который пишет в тот же чат
+        self.telegram_replay_share = float(os.getenv("TELEGRAM_REPLAY_SHARE", "0.25"))
+        self.telegram_group_chat_interval, _ = split_group_budget(
+            float(os.getenv("TELEGRAM_GROUP_CHAT_INTERVAL", "3.0")), self.telegram_replay_share
+        )
+        
+        # Обработка пачки в худшем случае: все сообщения пачки уходят в один групповой чат с учётом его лимита
+        self.worst_case_batch = (
+            self.kafka_max_poll_records * max(self.telegram_group_chat_interval, self.telegram_private_chat_interval)
+            + 1.0
+        )
+        # Запас на один повтор после 429 для каждого сообщения: пачка не должна выходить за max.poll.interval.ms,
+        # иначе consumer исключается из группы, commit не проходит и пачка отправляется повторно
+        min_poll_interval_ms = int(self.worst_case_batch * 2 * 1000)
+        self.kafka_max_poll_interval_ms = int(os.getenv("KAFKA_MAX_POLL_INTERVAL_MS", str(min_poll_interval_ms)))
+        if self.kafka_max_poll_interval_ms < min_poll_interval_ms:
+            logger.warning(
+                f"KAFKA_MAX_POLL_INTERVAL_MS={self.kafka_max_poll_interval_ms} меньше обработки пачки в худшем случае, "
+                f"используется {min_poll_interval_ms}"
+            )
+            self.kafka_max_poll_interval_ms = min_poll_interval_ms
+        
+        # Конфигурация рассылки по нескольким чатам (куратор + командный чат)
+        self.fanout_enabled = os.getenv("TELEGRAM_FANOUT_ENABLED", "false").lower() == "true"
+        self.crm_api_url = os.getenv("CRM_API_URL", "http://backend:5001/api")
+        self.crm_api_email = os.getenv("CRM_API_EMAIL")
+        self.crm_api_password = os.getenv("CRM_API_PASSWORD")
+        self.worker_chats = RecipientResolver.parse_worker_chats(os.getenv("TELEGRAM_WORKER_CHATS", ""))
+        self.recipient_cache_ttl = float(os.getenv("RECIPIENT_CACHE_TTL", "300"))
+        self.recipient_negative_cache_ttl = float(os.getenv("RECIPIENT_NEGATIVE_CACHE_TTL", "60"))
+        self.recipient_failure_cache_ttl = float(os.getenv("RECIPIENT_FAILURE_CACHE_TTL", "30"))
+        
+        # Трассировка и профилирование (по умолчанию выключены)
+        self.tracing_enabled = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+        self.tracer = Tracer(
+            enabled=self.tracing_enabled,
+            slow_threshold_ms=float(os.getenv("TRACE_SLOW_MS", "500"))
+        )
+        self.loop_monitor = LoopLagMonitor(
+            interval=float(os.getenv("LOOP_LAG_INTERVAL", "0.5")),
+            warn_threshold_ms=float(os.getenv("LOOP_LAG_WARN_MS", "100"))
+        )
+        self.profiler = SamplingProfiler(
+            output_dir="logs",
+            duration=float(os.getenv("PROFILE_DURATION", "10")),
+            frequency=int(os.getenv("PROFILE_FREQUENCY", "100")),
+            max_duration=float(os.getenv("PROFILE_MAX_DURATION", "60"))
+        )
+        
+        # Конфигурация health/readiness эндпоинтов
+        self.health_enabled = os.getenv("HEALTH_SERVER_ENABLED", "true").lower() == "true"
+        self.service_port = int(os.getenv("SERVICE_PORT", "8000"))
+        # Таймаут не может быть меньше времени обработки пачки в худшем случае
+        self.consumer_stall_timeout = float(os.getenv("CONSUMER_STALL_TIMEOUT", str(self.worst_case_batch)))
+        if self.consumer_stall_timeout < self.worst_case_batch:
+            logger.warning(
+                f"CONSUMER_STALL_TIMEOUT={self.consumer_stall_timeout}s меньше обработки пачки в худшем случае, "
+                f"используется {self.worst_case_batch}s"
+            )
+            self.consumer_stall_timeout = self.worst_case_batch
+        self.telegram_check_ttl = float(os.getenv("TELEGRAM_CHECK_TTL", "30"))
+        self.health_server: HealthServer = None
         
         # Клиенты
         self.kafka_client: KafkaClient = None
         self.telegram_client: TelegramClient = None
+        self.recipient_resolver: RecipientResolver = None
         
         # Флаг для graceful shutdown
         self.running = False
@@ -72,6 +145,14 @@ class TelegramBotService:
             # Установка обработчика сигналов для graceful shutdown
             self.setup_signal_handlers()
             
+            if self.tracing_enabled:
+                self.loop_monitor.start()
+                self.profiler.install_signal_handler()
+                logger.info("Трассировка обработки сообщений включена")
+            
+            if self.health_enabled:
+                await self.setup_health_server()
+            
             # Бесконечный цикл для обработки сообщений
             self.running = True
             await self.kafka_client.start_consuming()
@@ -84,27 +165,49 @@ class TelegramBotService:
     
     def setup_signal_handlers(self):
         """Настройка обработчиков сигналов"""
-        def signal_handler(signum, frame):
+        def signal_handler(signum):
             logger.info(f"Получен сигнал {signum}, начинаем graceful shutdown...")
             self.running = False
+            if self.kafka_client:
+                # Текущая пачка не дообрабатывается: фиксируется только обработанное, остальное придёт повторно
+                self.kafka_client.request_stop()
         
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        # Обработчики в event loop: остановка будит ожидание пачки в KafkaClient
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, signal_handler, signum)
     
     async def setup_kafka_consumer(self):
         """Настройка Kafka consumer"""
         logger.info(f"Настройка Kafka consumer для брокеров: {self.kafka_brokers}")
         
+        # Один consumer на оба топика: общее подключение и общий батчинг
+        topics = [self.kafka_topic, self.kafka_error_topic]
         self.kafka_client = KafkaClient(
             brokers=self.kafka_brokers,
-            topic=self.kafka_topic,
-            group_id=self.kafka_group_id
+            topic=topics,
+            group_id=self.kafka_group_id,
+            pattern=self.kafka_topic_pattern,
+            max_poll_records=self.kafka_max_poll_records,
+            max_poll_interval_ms=self.kafka_max_poll_interval_ms,
+            shutdown_timeout=self.kafka_shutdown_timeout,
+            tracer=self.tracer
         )
         
-        # Установка обработчика сообщений
-        self.kafka_client.set_message_handler(self.process_message)
+        # Установка обработчиков сообщений по топикам
+        self.kafka_client.register_handler(
+            self.kafka_topic, self.process_message, concurrency=self.accepted_concurrency
+        )
+        self.kafka_client.register_handler(
+            self.kafka_error_topic, self.process_error_message, concurrency=self.error_concurrency
+        )
         
-        logger.info(f"✅ Kafka consumer настроен для топика: {self.kafka_topic}")
+        if self.kafka_topic_pattern:
+            # Под шаблон могут попасть и другие топики: без обработчика их сообщения были бы пропущены
+            self.kafka_client.set_message_handler(self.process_message)
+            logger.info(f"✅ Kafka consumer настроен для шаблона: {self.kafka_topic_pattern}")
+        else:
+            logger.info(f"✅ Kafka consumer настроен для топиков: {', '.join(topics)}")
     
     async def setup_telegram_bot(self):
         """Настройка Telegram бота"""
@@ -116,11 +219,46 @@ class TelegramBotService:
         
         self.telegram_client = TelegramClient(
             token=self.telegram_token,
-            chat_id=self.telegram_chat_id
+            chat_id=self.telegram_chat_id,
+            private_chat_interval=self.telegram_private_chat_interval,
+            group_chat_interval=self.telegram_group_chat_interval
         )
         
         await self.telegram_client.setup()
         logger.info("Telegram бот настроен")
+        
+        if self.fanout_enabled:
+            # Резолвер использует ту же HTTP сессию, что и Telegram клиент
+            self.recipient_resolver = RecipientResolver(
+                crm_api_url=self.crm_api_url,
+                crm_api_email=self.crm_api_email,
+                crm_api_password=self.crm_api_password,
+                team_chat_id=self.telegram_chat_id,
+                team_thread_id=2,
+                worker_chats=self.worker_chats,
+                cache_ttl=self.recipient_cache_ttl,
+                negative_cache_ttl=self.recipient_negative_cache_ttl,
+                failure_cache_ttl=self.recipient_failure_cache_ttl,
+                session=self.telegram_client.session
+            )
+            logger.info("Рассылка по нескольким чатам включена (куратор + командный чат)")
+    
+    async def setup_health_server(self):
+        """Запуск HTTP эндпоинтов /healthz, /readyz и /lag"""
+        # Liveness опирается на мониторинг лага event loop
+        self.loop_monitor.start()
+        
+        self.health_server = HealthServer(
+            kafka_client=self.kafka_client,
+            telegram_client=self.telegram_client,
+            loop_monitor=self.loop_monitor,
+            tracer=self.tracer,
+            profiler=self.profiler if self.tracing_enabled else None,
+            port=self.service_port,
+            stall_timeout=self.consumer_stall_timeout,
+            telegram_check_ttl=self.telegram_check_ttl
+        )
+        await self.health_server.start()
     
     async def test_telegram_connection(self):
         """Тестирование подключения к Telegram"""
@@ -151,8 +289,13 @@ class TelegramBotService:
                 return
             
             # Форматирование и отправка уведомления
-            if self.telegram_client:
-                notification_text = self.telegram_client.format_notification(event_type, data)
+            if self.telegram_client and self.recipient_resolver:
+                with stage("format"):
+                    notification_text = self.telegram_client.format_notification(event_type, data)
+                await self.fan_out_notification(notification_text, event_type, data)
+            elif self.telegram_client:
+                with stage("format"):
+                    notification_text = self.telegram_client.format_notification(event_type, data)
                 # Отправляем сообщение в топик "Alerts"
                 success = await self.telegram_client.send_message_to_topic(notification_text, "Alerts")
                 
@@ -166,13 +309,60 @@ class TelegramBotService:
         except Exception as e:
             logger.error(f"Ошибка обработки сообщения: {e}")
     
+    async def fan_out_notification(self, text: str, event_type: str, data: Dict[str, Any]):
+        """Рассылка уведомления всем получателям события"""
+        recipients = await self.recipient_resolver.resolve(data)
+        if not recipients:
+            logger.warning(f"Нет получателей для события: {event_type}")
+            return
+        
+        results = await self.telegram_client.send_message_to_chats(text, recipients)
+        delivered = [chat_id for chat_id, ok in results.items() if ok]
+        failed = [chat_id for chat_id, ok in results.items() if not ok]
+        
+        if failed:
+            logger.error(f"❌ Уведомление {event_type} не доставлено в чаты: {failed} (доставлено: {delivered})")
+        else:
+            logger.info(f"✅ Уведомление {event_type} доставлено в чаты: {delivered}")
+    
+    async def process_error_message(self, message: Dict[str, Any]):
+        """Обработка сообщений из crm-msgError (алерты)"""
+        logger.warning(f"Обработка сообщения из {self.kafka_error_topic}: {message}")
+        
+        try:
+            event_type = message.get("event_type", "unknown")
+            data = message.get("data", {})
+            
+            if self.telegram_client:
+                with stage("format"):
+                    alert_text = self.telegram_client.format_error_notification(event_type, data)
+                success = await self.telegram_client.send_message_to_topic(alert_text, "Alerts")
+                
+                if success:
+                    logger.info(f"✅ Алерт отправлен в Telegram топик 'Alerts' для события: {event_type}")
+                else:
+                    logger.error(f"❌ Не удалось отправить алерт для события: {event_type}")
+            else:
+                logger.warning("Telegram клиент не настроен, алерт не отправлен")
+                
+        except Exception as e:
+            logger.error(f"Ошибка обработки сообщения об ошибке: {e}")
+    
     async def cleanup(self):
         """Очистка ресурсов при завершении"""
         logger.info("Очистка ресурсов...")
         
+        if self.health_server:
+            await self.health_server.stop()
+        
+        await self.loop_monitor.stop()
+        
         if self.kafka_client:
             await self.kafka_client.stop()
         
+        if self.recipient_resolver:
+            await self.recipient_resolver.close()
+        
         if self.telegram_client:
             await self.telegram_client.close()
         
@@ -0,0 +1,226 @@
+"""
+Recipient Resolver Module
+Модуль для определения получателей уведомлений (куратор клиента + командный чат)
+"""
+
+import asyncio
+import time
+from typing import Dict, Any, List, Optional, Set, Tuple
+from loguru import logger
+import aiohttp
+
+Recipient = Tuple[str, Optional[int]]
+
+
+class CrmAuthError(Exception):
+    """Не удалось авторизоваться в CRM API"""
+
+
+class RecipientResolver:
+    """Определение чатов-получателей события с кэшированием"""
+
+    def __init__(
+        self,
+        crm_api_url: str,
+        crm_api_email: str = None,
+        crm_api_password: str = None,
+        team_chat_id: str = None,
+        team_thread_id: Optional[int] = None,
+        worker_chats: Dict[str, str] = None,
+        cache_ttl: float = 300.0,
+        negative_cache_ttl: float = 60.0,
+        failure_cache_ttl: float = 30.0,
+        session: Optional[aiohttp.ClientSession] = None
+    ):
+        self.crm_api_url = crm_api_url.rstrip("/") if crm_api_url else None
+        self.crm_api_email = crm_api_email
+        self.crm_api_password = crm_api_password
+        self.team_chat_id = team_chat_id
+        self.team_thread_id = team_thread_id
+        # telegram_username (без @) -> chat_id. Bot API не принимает @username личных чатов,
+        # поэтому работники без сопоставления пропускаются
+        self.worker_chats = {k.lstrip("@").lower(): v for k, v in (worker_chats or {}).items()}
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.failure_cache_ttl = failure_cache_ttl
+        self.session = session
+        self._owns_session = session is None
+
+        # Токены CRM API (access живёт 15 минут, обновляется через refresh или повторный вход)
+        self._access_token: Optional[str] = None
+        self._refresh_token: Optional[str] = None
+        self._auth_lock = asyncio.Lock()
+
+        # client_id -> (время истечения, chat_id куратора или None)
+        self._curator_cache: Dict[Any, Tuple[float, Optional[str]]] = {}
+        # Запросы в полёте, чтобы одновременные события одного клиента не дублировали запрос к API
+        self._pending: Dict[Any, asyncio.Future] = {}
+        # Работники без chat_id, о которых уже предупредили в логе
+        self._unmapped_warned: Set[str] = set()
+
+    @staticmethod
+    def parse_worker_chats(value: str) -> Dict[str, str]:
+        """Разбор строки вида 'username1=chat_id1,username2=chat_id2'"""
+        mapping = {}
+        for item in (value or "").split(","):
+            if "=" in item:
+                username, chat_id = item.split("=", 1)
+                if username.strip() and chat_id.strip():
+                    mapping[username.strip()] = chat_id.strip()
+        return mapping
+
+    async def setup(self):
+        """Настройка HTTP сессии"""
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+            self._owns_session = True
+
+    async def close(self):
+        """Закрытие HTTP сессии (если она создана резолвером)"""
+        if self.session and self._owns_session:
+            await self.session.close()
+        self.session = None
+
+    async def resolve(self, data: Dict[str, Any]) -> List[Recipient]:
+        """Список получателей события: куратор клиента и командный чат"""
+        recipients: List[Recipient] = []
+
+        client_id = data.get("client_id")
+        if client_id is not None:
+            curator_chat_id = await self.get_curator_chat(client_id)
+            if curator_chat_id:
+                recipients.append((curator_chat_id, None))
+
+        if self.team_chat_id and all(chat_id != self.team_chat_id for chat_id, _ in recipients):
+            recipients.append((self.team_chat_id, self.team_thread_id))
+
+        return recipients
+
+    async def get_curator_chat(self, client_id: Any) -> Optional[str]:
+        """Chat ID куратора клиента (из кэша или CRM API)"""
+        cached = self._curator_cache.get(client_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        pending = self._pending.get(client_id)
+        if pending:
+            return await pending
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[client_id] = future
+        try:
+            chat_id = await self._fetch_curator_chat(client_id)
+            # Отсутствие куратора кэшируем ненадолго: его могут назначить в любой момент
+            ttl = self.cache_ttl if chat_id else self.negative_cache_ttl
+            self._curator_cache[client_id] = (time.monotonic() + ttl, chat_id)
+            future.set_result(chat_id)
+            return chat_id
+        except Exception as e:
+            # Ошибки тоже кэшируются, чтобы недоступный API не запрашивался на каждое событие
+            self._curator_cache[client_id] = (time.monotonic() + self.failure_cache_ttl, None)
+            future.set_result(None)
+            logger.error(f"Ошибка определения куратора клиента {client_id}: {e}")
+            return None
+        finally:
+            self._pending.pop(client_id, None)
+            if not future.done():
+                # Запрос отменён вместе с задачей-владельцем: ожидающие не должны зависнуть
+                future.set_result(None)
+
+    def invalidate(self, client_id: Any = None):
+        """Сброс кэша (для одного клиента или полностью)"""
+        if client_id is None:
+            self._curator_cache.clear()
+        else:
+            self._curator_cache.pop(client_id, None)
+
+    async def _login(self):
+        """Вход в CRM API под сервисной учётной записью"""
+        if not self.crm_api_email or not self.crm_api_password:
+            raise CrmAuthError("CRM_API_EMAIL / CRM_API_PASSWORD не заданы")
+
+        url = f"{self.crm_api_url}/auth/login"
+        payload = {"email": self.crm_api_email, "password": self.crm_api_password}
+        async with self.session.post(url, json=payload) as response:
+            if response.status != 200:
+                raise CrmAuthError(f"Ошибка входа в CRM API: HTTP {response.status}")
+            result = await response.json()
+
+        self._access_token = result.get("accessToken")
+        self._refresh_token = result.get("refreshToken")
+        logger.info("Вход в CRM API выполнен")
+
+    async def _refresh_access_token(self, rejected_token: Optional[str]):
+        """Обновление access токена: через refresh токен, при неудаче — повторный вход"""
+        async with self._auth_lock:
+            # Токен уже обновлён параллельным запросом
+            if self._access_token and self._access_token != rejected_token:
+                return
+
+            if self._refresh_token:
+                url = f"{self.crm_api_url}/auth/refresh"
+                async with self.session.post(url, json={"refreshToken": self._refresh_token}) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        self._access_token = result.get("accessToken")
+                        if self._access_token:
+                            return
+
+            await self._login()
+
+    async def _get_curator(self, client_id: Any) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """GET /clients/:id/curator с текущим access токеном"""
+        url = f"{self.crm_api_url}/clients/{client_id}/curator"
+        headers = {"Authorization": f"Bearer {self._access_token}"} if self._access_token else {}
+        async with self.session.get(url, headers=headers) as response:
+            if response.status != 200:
+                return response.status, None
+            return response.status, await response.json()
+
+    async def _fetch_curator_chat(self, client_id: Any) -> Optional[str]:
+        """Запрос куратора клиента в CRM API"""
+        if not self.crm_api_url:
+            return None
+
+        await self.setup()
+
+        if not self._access_token:
+            await self._refresh_access_token(None)
+
+        token = self._access_token
+        status, body = await self._get_curator(client_id)
+        if status in (401, 403):
+            await self._refresh_access_token(token)
+            status, body = await self._get_curator(client_id)
+
+        if status == 404:
+            return None
+        if status != 200:
+            raise RuntimeError(f"HTTP ошибка при получении куратора: {status}")
+
+        username = self._extract_username(body)
+        if not username:
+            return None
+
+        chat_id = self.worker_chats.get(username.lower())
+        if chat_id is None and username.lower() not in self._unmapped_warned:
+            self._unmapped_warned.add(username.lower())
+            logger.warning(f"Для работника @{username} не задан chat_id в TELEGRAM_WORKER_CHATS, уведомления куратору не отправляются")
+        return chat_id
+
+    @staticmethod
+    def _extract_username(body: Any) -> Optional[str]:
+        """telegram_username из ответа CRM API
+
+        Адаптер /api/clients в backend/server.js разворачивает {success, data} в data,
+        поэтому куратор приходит плоским объектом. Если куратора нет (data: null),
+        адаптер возвращает исходный {success: true, data: null}.
+        """
+        if not isinstance(body, dict):
+            return None
+        if "success" in body:
+            body = body.get("data")
+            if not isinstance(body, dict):
+                return None
+        username = (body.get("telegram_username") or "").strip().lstrip("@")
+        return username or None
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Replay Script
+Повторная обработка исторических сообщений из Kafka (replay / backfill)
+
+Примеры:
+    python replay.py --from-timestamp 2024-01-15T10:00:00 --dry-run --output replay.jsonl
+    python replay.py --from-offset 1200 --to-offset 1500 --coalesce
+    python replay.py --resume --to-offset 1500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+from loguru import logger
+from dotenv import load_dotenv
+from kafka import KafkaConsumer, TopicPartition
+
+from kafka_client import make_offset
+from telegram_client import TelegramClient, GROUP_CHAT_LIMIT_INTERVAL, split_group_budget
+
+# Загрузка переменных окружения
+load_dotenv()
+
+
+class RateLimiter:
+    """Ограничение скорости отправки (token bucket)"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def parse_timestamp(value: str) -> int:
+    """Разбор ISO-даты или unix-времени в миллисекунды"""
+    if value.isdigit():
+        number = int(value)
+        # Секунды или уже миллисекунды
+        return number * 1000 if number < 10 ** 11 else number
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def coalesce_events(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Схлопывание событий одного клиента: остаётся последнее событие каждого типа"""
+    merged: Dict[Tuple[Any, Any], Dict[str, Any]] = {}
+    for event in events:
+        message = event["message"]
+        data = message.get("data", {})
+        client_id = data.get("client_id")
+        if client_id is None:
+            # Без client_id схлопывать нечего
+            merged[(id(event), None)] = event
+            continue
+
+        key = (message.get("event_type"), client_id)
+        previous = merged.pop(key, None)
+        if previous and message.get("event_type") == "client_status_changed":
+            # Цепочка смен статуса: old_status из первого события, new_status из последнего
+            first_old_status = previous["message"].get("data", {}).get("old_status")
+            message = {**message, "data": {**data, "old_status": first_old_status}}
+            event = {**event, "message": message, "coalesced": previous.get("coalesced", 1) + 1}
+        merged[key] = event
+
+    return list(merged.values())
+
+
+class ReplayService:
+    """Повторная отправка сообщений топика в отдельной группе потребителей"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.kafka_brokers = os.getenv("KAFKA_BROKERS", "kafka:29092")
+        self.consumer: Optional[KafkaConsumer] = None
+        self.telegram_client: Optional[TelegramClient] = None
+        self.output_file = None
+        self.rate_limiter = RateLimiter(args.rate, args.burst)
+        self.stats = {"read": 0, "sent": 0, "failed": 0, "skipped": 0, "invalid": 0}
+
+    def setup_consumer(self) -> Dict[TopicPartition, int]:
+        """Настройка consumer и позиционирование на начальные offset'ы; возвращает конечные offset'ы"""
+        self.consumer = KafkaConsumer(
+            bootstrap_servers=self.kafka_brokers,
+            group_id=self.args.group_id,
+            enable_auto_commit=False,
+            max_poll_records=self.args.batch_size,
+            # Крупные выборки: для replay важна пропускная способность, а не задержка
+            fetch_min_bytes=self.args.fetch_min_bytes,
+            fetch_max_wait_ms=500
+        )
+
+        partitions = self.consumer.partitions_for_topic(self.args.topic)
+        if not partitions:
+            raise RuntimeError(f"Топик {self.args.topic} не найден")
+
+        topic_partitions = [TopicPartition(self.args.topic, p) for p in sorted(partitions)]
+        if self.args.partition is not None:
+            topic_partitions = [tp for tp in topic_partitions if tp.partition == self.args.partition]
+        self.consumer.assign(topic_partitions)
+
+        # Начальная позиция
+        if self.args.from_timestamp:
+            start_ms = parse_timestamp(self.args.from_timestamp)
+            offsets = self.consumer.offsets_for_times({tp: start_ms for tp in topic_partitions})
+            for tp in topic_partitions:
+                found = offsets.get(tp)
+                if found is None:
+                    # После указанного времени сообщений нет
+                    self.consumer.seek_to_end(tp)
+                else:
+                    self.consumer.seek(tp, found.offset)
+        elif self.args.from_offset is not None:
+            for tp in topic_partitions:
+                self.consumer.seek(tp, self.args.from_offset)
+        elif self.args.resume:
+            # Продолжение с offset'ов, зафиксированных предыдущим запуском в группе replay
+            for tp in topic_partitions:
+                committed = self.consumer.committed(tp)
+                if committed is None:
+                    raise RuntimeError(
+                        f"Для {tp.topic}[{tp.partition}] нет сохранённого offset'а в группе {self.args.group_id}: "
+                        f"укажите --from-offset или --from-timestamp"
+                    )
+                self.consumer.seek(tp, committed)
+        else:
+            self.consumer.seek_to_beginning(*topic_partitions)
+
+        # Конечная позиция фиксируется на старте, чтобы replay завершался
+        end_offsets = self.consumer.end_offsets(topic_partitions)
+        if self.args.to_offset is not None:
+            end_offsets = {tp: min(offset, self.args.to_offset + 1) for tp, offset in end_offsets.items()}
+
+        for tp in topic_partitions:
+            logger.info(f"Replay {tp.topic}[{tp.partition}]: с offset {self.consumer.position(tp)} до {end_offsets[tp]}")
+        return end_offsets
+
+    async def setup_telegram(self):
+        """Настройка Telegram клиента (используется и в dry-run для форматирования)"""
+        self.telegram_client = TelegramClient(
+            token=os.getenv("TELEGRAM_BOT_TOKEN"),
+            chat_id=os.getenv("TELEGRAM_CHAT_ID"),
+            private_chat_interval=float(os.getenv("TELEGRAM_PRIVATE_CHAT_INTERVAL", "1.0")),
+            # Интервал по доле replay: всплески --burst не выходят за бюджет чата
+            group_chat_interval=1 / self.args.rate if self.args.rate > 0 else GROUP_CHAT_LIMIT_INTERVAL
+        )
+        if not self.args.dry_run:
+            await self.telegram_client.setup()
+
+    async def run(self):
+        """Запуск replay"""
+        loop = asyncio.get_running_loop()
+        end_offsets = self.setup_consumer()
+        await self.setup_telegram()
+        to_timestamp_ms = parse_timestamp(self.args.to_timestamp) if self.args.to_timestamp else None
+
+        if self.args.output:
+            self.output_file = open(self.args.output, "w", encoding="utf-8")
+
+        try:
+            remaining = {tp for tp, end in end_offsets.items() if self.consumer.position(tp) < end}
+            while remaining:
+                batch = await loop.run_in_executor(
+                    None, lambda: self.consumer.poll(timeout_ms=1000, max_records=self.args.batch_size)
+                )
+
+                events = []
+                # Следующий offset после последнего сообщения пачки, входящего в диапазон replay
+                replayed: Dict[TopicPartition, int] = {}
+                for tp, messages in batch.items():
+                    for message in messages:
+                        if tp not in remaining:
+                            break
+                        if message.offset >= end_offsets[tp] or (
+                            to_timestamp_ms is not None and message.timestamp > to_timestamp_ms
+                        ):
+                            remaining.discard(tp)
+                            self.consumer.pause(tp)
+                            break
+                        # Некорректное сообщение пропускается, но его offset фиксируется вместе с пачкой
+                        replayed[tp] = message.offset + 1
+                        value = self.decode(message)
+                        if value is None:
+                            self.stats["invalid"] += 1
+                            continue
+                        events.append({
+                            "topic": message.topic,
+                            "partition": message.partition,
+                            "offset": message.offset,
+                            "timestamp": message.timestamp,
+                            "message": value
+                        })
+
+                for tp in list(remaining):
+                    if self.consumer.position(tp) >= end_offsets[tp]:
+                        remaining.discard(tp)
+
+                self.stats["read"] += len(events)
+                if self.args.coalesce:
+                    coalesced = coalesce_events(events)
+                    self.stats["skipped"] += len(events) - len(coalesced)
+                    events = coalesced
+
+                await self.process_batch(events)
+
+                if not self.args.dry_run and replayed:
+                    # Фиксируем только обработанный диапазон, чтобы --resume продолжил с нужного места
+                    await loop.run_in_executor(
+                        None, lambda: self.consumer.commit({tp: make_offset(offset) for tp, offset in replayed.items()})
+                    )
+
+                if self.args.pause > 0:
+                    # Пауза между пачками, чтобы не забирать ресурсы у live consumer
+                    await asyncio.sleep(self.args.pause)
+        finally:
+            await self.cleanup()
+
+        logger.info(
+            f"Replay завершён: прочитано {self.stats['read']}, отправлено {self.stats['sent']}, "
+            f"ошибок {self.stats['failed']}, схлопнуто {self.stats['skipped']}, некорректных {self.stats['invalid']}"
+        )
+
+    @staticmethod
+    def decode(message: Any) -> Optional[Dict[str, Any]]:
+        """Разбор значения сообщения; tombstone и некорректный JSON не должны останавливать replay"""
+        try:
+            if message.value is None:
+                raise ValueError("пустое значение (tombstone)")
+            value = json.loads(message.value.decode('utf-8'))
+            if not isinstance(value, dict):
+                raise ValueError(f"ожидался объект, получено {type(value).__name__}")
+            return value
+        except Exception as e:
+            logger.error(f"Некорректное сообщение {message.topic}[{message.partition}]@{message.offset}: {e}")
+            return None
+
+    async def process_batch(self, events: List[Dict[str, Any]]):
+        """Форматирование и отправка (или запись в файл) пачки событий"""
+        for event in events:
+            message = event["message"]
+            event_type = message.get("event_type")
+            if not event_type:
+                logger.warning(f"Сообщение без event_type пропущено: offset {event['offset']}")
+                continue
+
+            text = self.telegram_client.format_notification(event_type, message.get("data", {}))
+
+            if self.args.dry_run:
+                self.write_output({**event, "text": text})
+                self.stats["sent"] += 1
+                continue
+
+            await self.rate_limiter.acquire()
+            success = await self.telegram_client.send_message_to_topic(text, "Alerts")
+            self.stats["sent" if success else "failed"] += 1
+            self.write_output({**event, "text": text, "delivered": success})
+
+    def write_output(self, record: Dict[str, Any]):
+        """Запись результата в файл (JSON Lines) или в лог"""
+        if self.output_file:
+            self.output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        elif self.args.dry_run:
+            logger.info(f"[dry-run] {record['topic']}[{record['partition']}]@{record['offset']}: {record['text'][:80]}")
+
+    async def cleanup(self):
+        """Очистка ресурсов"""
+        if self.output_file:
+            self.output_file.close()
+        if self.consumer:
+            self.consumer.close()
+        if self.telegram_client:
+            await self.telegram_client.close()
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Replay сообщений Kafka в Telegram")
+    parser.add_argument("--topic", default=os.getenv("KAFKA_TOPIC", "crm-msgAccepted"), help="Топик для replay")
+    parser.add_argument("--group-id", default=os.getenv("KAFKA_REPLAY_GROUP_ID", "telegram_bot_replay"),
+                        help="Отдельная группа потребителей для replay")
+    parser.add_argument("--partition", type=int, default=None, help="Только указанная партиция")
+
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument("--from-offset", type=int, default=None, help="Начальный offset")
+    start.add_argument("--from-timestamp", default=None, help="Начальное время (ISO 8601 или unix)")
+    start.add_argument("--resume", action="store_true",
+                       help="Продолжить с offset'ов, сохранённых предыдущим запуском в группе replay")
+    parser.add_argument("--to-offset", type=int, default=None, help="Конечный offset (включительно)")
+    parser.add_argument("--to-timestamp", default=None, help="Конечное время (ISO 8601 или unix)")
+
+    parser.add_argument("--batch-size", type=int, default=500, help="Сообщений в одной пачке poll")
+    parser.add_argument("--fetch-min-bytes", type=int, default=64 * 1024, help="Минимальный размер выборки Kafka")
+    parser.add_argument("--coalesce", action="store_true", help="Схлопывать события одного клиента в пачке")
+    parser.add_argument("--dry-run", action="store_true", help="Не отправлять в Telegram")
+    parser.add_argument("--output", default=None, help="Файл для результатов (JSON Lines)")
+
+    parser.add_argument("--rate", type=float, default=float(os.getenv("REPLAY_RATE", "0")) or None,
+                        help="Максимум отправок в секунду; по умолчанию вся доля replay в лимите группового чата")
+    parser.add_argument("--burst", type=int, default=1, help="Допустимый всплеск отправок")
+    parser.add_argument("--pause", type=float, default=0.5, help="Пауза между пачками, сек")
+    args = parser.parse_args(argv)
+
+    if args.dry_run:
+        args.rate = args.rate or 0.0
+        return args
+
+    # Без явной начальной позиции replay отправил бы в чат всю историю топика
+    if args.from_offset is None and args.from_timestamp is None and not args.resume:
+        parser.error("укажите начальную позицию: --from-offset, --from-timestamp или --resume")
+
+    # Replay пишет в тот же групповой чат, что и сервис, и не должен выходить за оставленную ему долю лимита
+    _, max_rate = split_group_budget(
+        float(os.getenv("TELEGRAM_GROUP_CHAT_INTERVAL", "3.0")), float(os.getenv("TELEGRAM_REPLAY_SHARE", "0.25"))
+    )
+    if max_rate <= 0:
+        parser.error("в лимите группового чата нет доли для replay: задайте TELEGRAM_REPLAY_SHARE больше 0")
+    if args.rate is None:
+        args.rate = max_rate
+    elif not 0 < args.rate <= max_rate:
+        parser.error(f"--rate {args.rate} вне доли replay в лимите группового чата: допустимо не больше {max_rate:.4f}")
+    return args
+
+
+async def main(argv: List[str] = None):
+    """Главная функция"""
+    args = parse_args(argv)
+    service = ReplayService(args)
+    await service.run()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Replay остановлен пользователем")
+    except Exception as e:
+        logger.error(f"Критическая ошибка replay: {e}")
+        sys.exit(1)
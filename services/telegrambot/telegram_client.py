@@ -5,23 +5,56 @@ Telegram Client Module
 
 import asyncio
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from loguru import logger
 import aiohttp
 
+from tracing import stage
+
+# Лимит Telegram для группы/канала: ~20 сообщений в минуту
+GROUP_CHAT_LIMIT_INTERVAL = 3.0
+
+
+def split_group_budget(group_chat_interval: float, replay_share: float) -> Tuple[float, float]:
+    """Деление лимита группового чата между сервисом и replay: (интервал сервиса, сек; скорость replay, в секунду)"""
+    if not 0 <= replay_share < 1:
+        raise ValueError(f"Доля replay должна быть в диапазоне [0, 1), получено {replay_share}")
+    live_interval = max(group_chat_interval, GROUP_CHAT_LIMIT_INTERVAL / (1 - replay_share))
+    replay_rate = max(0.0, 1 / GROUP_CHAT_LIMIT_INTERVAL - 1 / live_interval)
+    return live_interval, replay_rate
+
+
 class TelegramClient:
     """Клиент для работы с Telegram Bot API"""
     
-    def __init__(self, token: str, chat_id: str):
+    def __init__(
+        self,
+        token: str,
+        chat_id: str,
+        private_chat_interval: float = 1.0,
+        group_chat_interval: float = 3.0,
+        max_concurrent_requests: int = 20
+    ):
         self.token = token
         self.chat_id = chat_id
         self.base_url = f"https://api.telegram.org/bot{token}"
         self.session: Optional[aiohttp.ClientSession] = None
+        
+        # Лимиты Telegram: ~1 сообщение в секунду в личный чат и ~20 в минуту в группу/канал
+        self.private_chat_interval = private_chat_interval
+        self.group_chat_interval = group_chat_interval
+        self.max_concurrent_requests = max_concurrent_requests
+        self._chat_locks: Dict[str, asyncio.Lock] = {}
+        # chat_id -> момент (loop.time()), раньше которого в чат отправлять нельзя
+        self._chat_next_allowed: Dict[str, float] = {}
+        self._request_semaphore = asyncio.Semaphore(max_concurrent_requests)
     
     async def setup(self):
         """Настройка HTTP сессии"""
         if not self.session:
-            self.session = aiohttp.ClientSession()
+            # Одна сессия (и пул соединений) на все чаты
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent_requests)
+            self.session = aiohttp.ClientSession(connector=connector)
             logger.info("HTTP сессия для Telegram API создана")
     
     async def close(self):
@@ -31,9 +64,31 @@ class TelegramClient:
             self.session = None
             logger.info("HTTP сессия для Telegram API закрыта")
     
-    async def send_message(self, text: str, parse_mode: str = "HTML", message_thread_id: int = None) -> bool:
-        """Отправка текстового сообщения"""
-        if not self.token or not self.chat_id:
+    def _chat_interval(self, chat_id: str) -> float:
+        """Интервал между сообщениями в чат: у групп и каналов отрицательный ID или @username"""
+        if chat_id.startswith("-") or chat_id.startswith("@"):
+            return self.group_chat_interval
+        return self.private_chat_interval
+    
+    async def _wait_chat_slot(self, chat_id: str):
+        """Ожидание, пока в чат снова можно отправлять (лимит Telegram на чат)"""
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            delay = self._chat_next_allowed.get(chat_id, 0.0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._chat_next_allowed[chat_id] = loop.time() + self._chat_interval(chat_id)
+    
+    def _defer_chat(self, chat_id: str, retry_after: float):
+        """Сдвиг слота чата после ответа 429 Too Many Requests"""
+        next_allowed = asyncio.get_running_loop().time() + retry_after
+        self._chat_next_allowed[chat_id] = max(self._chat_next_allowed.get(chat_id, 0.0), next_allowed)
+    
+    async def send_message(self, text: str, parse_mode: str = "HTML", message_thread_id: int = None, chat_id: str = None) -> bool:
+        """Отправка текстового сообщения (по умолчанию в основной чат)"""
+        target_chat_id = chat_id or self.chat_id
+        if not self.token or not target_chat_id:
             logger.warning("Не удалось отправить сообщение: не настроен Telegram бот")
             return False
         
@@ -42,7 +97,7 @@ class TelegramClient:
         try:
             url = f"{self.base_url}/sendMessage"
             data = {
-                "chat_id": self.chat_id,
+                "chat_id": target_chat_id,
                 "text": text,
                 "parse_mode": parse_mode
             }
@@ -51,18 +106,31 @@ class TelegramClient:
             if message_thread_id:
                 data["message_thread_id"] = message_thread_id
             
-            async with self.session.post(url, json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if result.get("ok"):
-                        logger.info(f"Сообщение отправлено в Telegram: {text[:50]}...")
-                        return True
-                    else:
-                        logger.error(f"Ошибка Telegram API: {result}")
-                        return False
-                else:
-                    logger.error(f"HTTP ошибка при отправке сообщения: {response.status}")
-                    return False
+            # Одна повторная попытка, если Telegram ответил 429 с retry_after
+            for attempt in range(2):
+                with stage("rate_limit"):
+                    await self._wait_chat_slot(str(target_chat_id))
+                with stage("http"):
+                    async with self._request_semaphore, self.session.post(url, json=data) as response:
+                        if response.status == 200:
+                            result = await response.json()
+                            if result.get("ok"):
+                                logger.info(f"Сообщение отправлено в Telegram ({target_chat_id}): {text[:50]}...")
+                                return True
+                            else:
+                                logger.error(f"Ошибка Telegram API: {result}")
+                                return False
+                        elif response.status == 429:
+                            result = await response.json(content_type=None)
+                            retry_after = float((result.get("parameters") or {}).get("retry_after", 1))
+                            self._defer_chat(str(target_chat_id), retry_after)
+                            logger.warning(f"Лимит Telegram для чата {target_chat_id}: повтор через {retry_after}s")
+                        else:
+                            logger.error(f"HTTP ошибка при отправке сообщения: {response.status}")
+                            return False
+            
+            logger.error(f"Не удалось отправить сообщение в чат {target_chat_id}: превышен лимит Telegram")
+            return False
                     
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения в Telegram: {e}")
@@ -206,6 +274,24 @@ class TelegramClient:
         
         return await self.send_message(text, parse_mode, message_thread_id)
     
+    async def send_message_to_chats(self, text: str, recipients: List[Tuple[str, Optional[int]]], parse_mode: str = "HTML") -> Dict[str, bool]:
+        """Параллельная рассылка сообщения нескольким получателям (chat_id, message_thread_id)"""
+        if not recipients:
+            return {}
+        
+        results = await asyncio.gather(
+            *(self.send_message(text, parse_mode, thread_id, chat_id=chat_id) for chat_id, thread_id in recipients),
+            return_exceptions=True
+        )
+        
+        # Результат доставки по каждому получателю
+        delivery: Dict[str, bool] = {}
+        for (chat_id, _), result in zip(recipients, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка рассылки в чат {chat_id}: {result}")
+            delivery[str(chat_id)] = result is True
+        return delivery
+    
     def format_notification(self, event_type: str, data: Dict[str, Any]) -> str:
         """Форматирование уведомления для Telegram (только клиенты)"""
         if event_type == "client_created":
@@ -242,3 +328,8 @@ class TelegramClient:
 Тип: {event_type}
 Данные: {data}
             """.strip()
+    
+    def format_error_notification(self, event_type: str, data: Dict[str, Any]) -> str:
+        """Форматирование алерта для событий из crm-msgError"""
+        details = self.format_notification(event_type, data)
+        return f"🚨 <b>ALERT: событие из crm-msgError</b>\n\n{details}"
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Test Kafka Client
+Тесты обработки пачки KafkaClient без брокера: лаг по незавершённым offset'ам, порядок событий клиента, остановка
+"""
+
+import asyncio
+import json
+import unittest
+from collections import namedtuple
+from kafka import TopicPartition
+
+from kafka_client import KafkaClient
+
+Record = namedtuple("Record", "topic partition offset key value")
+
+
+def make_record(offset: int, data: dict, topic: str = "crm-msgAccepted") -> Record:
+    return Record(topic, 0, offset, None, json.dumps({"event_type": "test", "data": data}).encode("utf-8"))
+
+
+class KafkaClientBatchTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = KafkaClient("kafka:29092", topic="crm-msgAccepted", shutdown_timeout=0.05)
+        self.tp = TopicPartition("crm-msgAccepted", 0)
+
+    def load_batch(self, records, highwater: int):
+        """Состояние, которое _poll оставляет после получения пачки"""
+        self.client._highwater = {"crm-msgAccepted[0]": highwater}
+        self.client._pending_offsets = {self.tp: {record.offset for record in records}}
+        self.client._next_offsets = {self.tp: records[-1].offset + 1}
+        return {self.tp: records}
+
+    async def test_lag_waits_for_lowest_unfinished_offset(self):
+        release = {offset: asyncio.Event() for offset in range(3)}
+
+        async def handler(message):
+            await release[message["data"]["offset"]].wait()
+
+        self.client.register_handler("crm-msgAccepted", handler)
+        batch = self.load_batch([make_record(offset, {"offset": offset}) for offset in range(3)], highwater=10)
+        dispatch = asyncio.create_task(self.client._dispatch_batch(batch))
+        await asyncio.sleep(0)
+
+        # Более поздние сообщения завершились первыми: лаг не уменьшается
+        release[2].set()
+        release[1].set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.client.get_stats()["lag"], {"crm-msgAccepted[0]": 10})
+
+        release[0].set()
+        await dispatch
+        self.assertEqual(self.client.get_stats()["lag"], {"crm-msgAccepted[0]": 7})
+
+    async def test_records_without_handler_advance_lag(self):
+        batch = self.load_batch([make_record(offset, {}) for offset in range(3)], highwater=3)
+        await self.client._dispatch_batch(batch)
+        self.assertEqual(self.client.get_stats()["lag"], {"crm-msgAccepted[0]": 0})
+
+    async def test_events_of_one_client_keep_order(self):
+        handled = []
+        first_started = asyncio.Event()
+        release_first = asyncio.Event()
+
+        async def handler(message):
+            data = message["data"]
+            if data["offset"] == 0:
+                first_started.set()
+                await release_first.wait()
+            handled.append(data["offset"])
+
+        self.client.register_handler("crm-msgAccepted", handler)
+        batch = self.load_batch([
+            make_record(0, {"client_id": 1, "offset": 0}),
+            make_record(1, {"client_id": 1, "offset": 1}),
+            make_record(2, {"client_id": 2, "offset": 2})
+        ], highwater=3)
+        dispatch = asyncio.create_task(self.client._dispatch_batch(batch))
+        await first_started.wait()
+        await asyncio.sleep(0.01)
+
+        # Другой клиент не ждёт, следующее событие того же клиента ждёт предыдущее
+        self.assertEqual(handled, [2])
+        release_first.set()
+        await dispatch
+        self.assertEqual(handled, [2, 0, 1])
+
+    async def test_stop_leaves_unprocessed_records_uncommitted(self):
+        handled = []
+        first_started = asyncio.Event()
+
+        async def handler(message):
+            data = message["data"]
+            if data["offset"] == 0:
+                first_started.set()
+                # Отправка, которая не успевает завершиться до остановки
+                await asyncio.Event().wait()
+            handled.append(data["offset"])
+
+        self.client.register_handler("crm-msgAccepted", handler, concurrency=2)
+        batch = self.load_batch([
+            make_record(0, {"client_id": 1, "offset": 0}),
+            make_record(1, {"client_id": 2, "offset": 1}),
+            make_record(2, {"client_id": 1, "offset": 2})
+        ], highwater=3)
+        dispatch = asyncio.create_task(self.client._dispatch_batch(batch))
+        await first_started.wait()
+        await asyncio.sleep(0.01)
+
+        self.client.request_stop()
+        await asyncio.wait_for(dispatch, 1)
+        self.assertEqual(handled, [1])
+        self.assertEqual(self.client._pending_offsets[self.tp], {0, 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
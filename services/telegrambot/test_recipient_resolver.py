@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Test Recipient Resolver
+Тесты определения получателей на ответах в формате CRM API (с адаптером /api/clients)
+"""
+
+import asyncio
+import unittest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from recipient_resolver import RecipientResolver
+
+
+class FakeCrmApi:
+    """CRM API с теми же формами ответов, что и backend (адаптер разворачивает {success, data})"""
+
+    def __init__(self):
+        self.curator_requests = 0
+        self.logins = 0
+        self.refreshes = 0
+        self.valid_tokens = set()
+        self.fail_curator = False
+        self.curator_delay = 0.0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/auth/login", self.login)
+        app.router.add_post("/api/auth/refresh", self.refresh)
+        app.router.add_get("/api/clients/{id}/curator", self.curator)
+        return app
+
+    async def login(self, request):
+        self.logins += 1
+        token = f"access-{self.logins}"
+        self.valid_tokens.add(token)
+        return web.json_response({"user": {"id": 1}, "accessToken": token, "refreshToken": "refresh"})
+
+    async def refresh(self, request):
+        self.refreshes += 1
+        token = f"refreshed-{self.refreshes}"
+        self.valid_tokens.add(token)
+        return web.json_response({"accessToken": token})
+
+    async def curator(self, request):
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if token not in self.valid_tokens:
+            return web.json_response({"error": "Invalid or expired token"}, status=403)
+
+        self.curator_requests += 1
+        await asyncio.sleep(self.curator_delay)
+        if self.fail_curator:
+            return web.json_response({"error": "Ошибка сервера"}, status=500)
+
+        client_id = request.match_info["id"]
+        if client_id == "1":
+            # data.data || data -> плоский объект работника
+            return web.json_response({
+                "id": 7, "full_name": "Петр Петров", "position": "Куратор",
+                "telegram_username": "@Petrov", "phone": None
+            })
+        if client_id == "2":
+            # Куратор не назначен: data.data === null, адаптер возвращает исходный объект
+            return web.json_response({"success": True, "data": None})
+        if client_id == "3":
+            return web.json_response({"id": 8, "full_name": "Без чата", "telegram_username": "unmapped"})
+        return web.json_response({"error": "Клиент не найден"}, status=404)
+
+
+class RecipientResolverTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = FakeCrmApi()
+        self.server = TestServer(self.api.app())
+        await self.server.start_server()
+        self.resolver = RecipientResolver(
+            crm_api_url=str(self.server.make_url("/api")),
+            crm_api_email="bot@example.com",
+            crm_api_password="secret",
+            team_chat_id="-100500",
+            team_thread_id=2,
+            worker_chats={"petrov": "111"}
+        )
+
+    async def asyncTearDown(self):
+        await self.resolver.close()
+        await self.server.close()
+
+    async def test_curator_and_team_chat(self):
+        recipients = await self.resolver.resolve({"client_id": 1})
+        self.assertEqual(recipients, [("111", None), ("-100500", 2)])
+
+    async def test_no_curator_is_cached(self):
+        self.assertEqual(await self.resolver.resolve({"client_id": 2}), [("-100500", 2)])
+        await self.resolver.resolve({"client_id": 2})
+        self.assertEqual(self.api.curator_requests, 1)
+
+    async def test_unmapped_worker_is_skipped(self):
+        self.assertEqual(await self.resolver.resolve({"client_id": 3}), [("-100500", 2)])
+
+    async def test_failures_are_cached(self):
+        self.api.fail_curator = True
+        self.assertEqual(await self.resolver.resolve({"client_id": 1}), [("-100500", 2)])
+        await self.resolver.resolve({"client_id": 1})
+        self.assertEqual(self.api.curator_requests, 1)
+
+    async def test_expired_token_is_refreshed(self):
+        await self.resolver.get_curator_chat(1)
+        self.api.valid_tokens.clear()
+        self.resolver.invalidate()
+
+        self.assertEqual(await self.resolver.get_curator_chat(1), "111")
+        self.assertEqual(self.api.logins, 1)
+        self.assertEqual(self.api.refreshes, 1)
+
+    async def test_waiters_are_released_when_lookup_is_cancelled(self):
+        self.api.curator_delay = 1.0
+        owner = asyncio.create_task(self.resolver.get_curator_chat(1))
+        await asyncio.sleep(0.1)
+        waiter = asyncio.create_task(self.resolver.get_curator_chat(1))
+        await asyncio.sleep(0)
+
+        owner.cancel()
+        self.assertIsNone(await asyncio.wait_for(waiter, 0.5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+"""
+Tracing Module
+Модуль для трассировки обработки сообщений: тайминги по этапам, лаг event loop, профилирование
+"""
+
+import asyncio
+import contextvars
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Any, Iterable, Optional
+from loguru import logger
+
+# Трассировка текущего сообщения (у каждой задачи обработчика свой контекст)
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("message_trace", default=None)
+_NOOP_STAGE = nullcontext()
+
+
+class MessageTrace:
+    """Тайминги этапов обработки одного сообщения"""
+
+    __slots__ = ("topic", "partition", "offset", "started_at", "stages")
+
+    def __init__(self, topic: str, partition: int, offset: int):
+        self.topic = topic
+        self.partition = partition
+        self.offset = offset
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, duration: float):
+        """Добавление длительности этапа (в секундах)"""
+        self.stages[stage] = self.stages.get(stage, 0.0) + duration
+
+    @property
+    def total(self) -> float:
+        """Время обработки с момента получения (fetch и commit учитываются на уровне пачки)"""
+        return time.perf_counter() - self.started_at
+
+    def describe(self) -> str:
+        """Текстовое описание этапов для лога"""
+        return ", ".join(f"{name}={duration * 1000:.1f}ms" for name, duration in self.stages.items())
+
+
+class Tracer:
+    """Трассировка сообщений и журнал медленных сообщений"""
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        slow_threshold_ms: float = 500.0,
+        throttle_stages: Iterable[str] = ("wait", "rate_limit")
+    ):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold_ms / 1000
+        # Намеренные ожидания (параллелизм, лимиты Telegram) не считаются медленной обработкой
+        self.throttle_stages = tuple(throttle_stages)
+        # Агрегаты по этапам: количество, суммарное и максимальное время
+        self.stage_stats: Dict[str, Dict[str, float]] = {}
+        self.slow_messages = 0
+
+    def start(self, topic: str, partition: int, offset: int) -> Optional[MessageTrace]:
+        """Начало трассировки сообщения в текущем контексте"""
+        if not self.enabled:
+            return None
+        trace = MessageTrace(topic, partition, offset)
+        _current_trace.set(trace)
+        return trace
+
+    def finish(self, trace: Optional[MessageTrace]):
+        """Завершение трассировки: обновление агрегатов и журнал медленных сообщений"""
+        if trace is None:
+            return
+        _current_trace.set(None)
+
+        total = trace.total
+        active = total - sum(trace.stages.get(name, 0.0) for name in self.throttle_stages)
+        for name, duration in trace.stages.items():
+            self.record(name, duration)
+        self.record("total", total)
+        self.record("active", active)
+
+        if active >= self.slow_threshold:
+            self.slow_messages += 1
+            logger.warning(
+                f"🐢 Медленное сообщение {trace.topic}[{trace.partition}]@{trace.offset}: "
+                f"обработка {active * 1000:.1f}ms без учёта ожидания ({', '.join(self.throttle_stages)}) "
+                f"и fetch/commit, всего {total * 1000:.1f}ms ({trace.describe()})"
+            )
+
+    def record(self, name: str, duration: float):
+        """Учёт длительности этапа в агрегатах (в том числе этапов уровня пачки)"""
+        stats = self.stage_stats.get(name)
+        if stats is None:
+            stats = self.stage_stats[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        stats["count"] += 1
+        stats["total"] += duration
+        if duration > stats["max"]:
+            stats["max"] = duration
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Сводка по этапам (в миллисекундах)"""
+        return {
+            name: {
+                "count": int(stats["count"]),
+                "avg_ms": round(stats["total"] / stats["count"] * 1000, 2) if stats["count"] else 0.0,
+                "max_ms": round(stats["max"] * 1000, 2)
+            }
+            for name, stats in self.stage_stats.items()
+        }
+
+
+@contextmanager
+def _timed_stage(trace: MessageTrace, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+
+def stage(name: str):
+    """Замер этапа текущего сообщения; без активной трассировки ничего не делает"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_STAGE
+    return _timed_stage(trace, name)
+
+
+class LoopLagMonitor:
+    """Мониторинг задержки event loop"""
+
+    def __init__(self, interval: float = 0.5, warn_threshold_ms: float = 100.0):
+        self.interval = interval
+        self.warn_threshold = warn_threshold_ms / 1000
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_tick = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск мониторинга в текущем event loop"""
+        if not self._task:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info(f"Мониторинг лага event loop запущен (интервал {self.interval}s)")
+
+    async def stop(self):
+        """Остановка мониторинга"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.last_lag = lag
+            self.last_tick = time.monotonic()
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag >= self.warn_threshold:
+                logger.warning(f"⏱ Лаг event loop: {lag * 1000:.1f}ms")
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик: снимает стеки основного потока в фоновом потоке"""
+
+    def __init__(
+        self, output_dir: str = "logs", duration: float = 10.0, frequency: int = 100, max_duration: float = 60.0
+    ):
+        self.output_dir = output_dir
+        self.duration = duration
+        self.max_duration = max_duration
+        self.frequency = frequency
+        self.target_thread_id = threading.main_thread().ident
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def install_signal_handler(self, signum: int = getattr(signal, "SIGUSR1", None)):
+        """Запуск профилирования по сигналу (по умолчанию SIGUSR1)"""
+        if signum is None:
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(signum, self.trigger)
+            logger.info(f"Профилировщик доступен по сигналу {signal.Signals(signum).name}")
+        except (NotImplementedError, RuntimeError) as e:
+            logger.warning(f"Не удалось установить обработчик сигнала профилировщика: {e}")
+
+    def trigger(self, duration: float = None) -> Optional[str]:
+        """Запуск профилирования; возвращает путь к файлу, куда будет записан результат"""
+        if self.running:
+            logger.warning("Профилирование уже выполняется")
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        self._thread = threading.Thread(
+            target=self._sample, args=(path, duration or self.duration), name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Профилирование запущено на {duration or self.duration}s, результат: {path}")
+        return path
+
+    def _sample(self, path: str, duration: float):
+        stacks: Counter = Counter()
+        interval = 1.0 / self.frequency
+        deadline = time.monotonic() + duration
+        samples = 0
+
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is not None:
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks[";".join(reversed(parts))] += 1
+                samples += 1
+            time.sleep(interval)
+
+        # Формат collapsed stacks (совместим с flamegraph.pl / speedscope)
+        with open(path, "w", encoding="utf-8") as output:
+            for stack, count in stacks.most_common():
+                output.write(f"{stack} {count}\n")
+        logger.info(f"Профилирование завершено: {samples} сэмплов записано в {path}")